@@ -6,10 +6,16 @@ import re
 import sys
 import json
 import errno
+import hashlib
 import shutil
+import signal
 import logging
 import argparse
-from typing import Optional
+import functools
+import tempfile
+import time
+from typing import Optional, Callable, List
+from concurrent.futures import ThreadPoolExecutor
 
 from common import (
     config as c,
@@ -29,44 +35,148 @@ from common import (
     git_ignore_dir,
     on_linux,
     get_ninja_build_type,
+    binary_in_path,
 )
 
+# written after a successful cargo build; lets need_cargo_clean skip
+# walking c.BUILD_DIR as long as nothing was rebuilt since.
+CLEAN_STAMP = os.path.join(c.BUILD_DIR, ".c2rust_clean_stamp")
 
-def download_llvm_sources():
+# records the cmake arguments a build tree was last configured with
+CMAKE_STAMP_NAME = ".c2rust_cmake_stamp"
+
+# bookkeeping files written by this script and by download_archive.
+# they never affect the c2rust binary so need_cargo_clean ignores them.
+BOOKKEEPING_SUFFIXES = (os.path.basename(CLEAN_STAMP),
+                        CMAKE_STAMP_NAME,
+                        ".verified")
+
+# prefix of the scratch directories LLVM archives are extracted into
+EXTRACT_PREFIX = ".extract-"
+
+
+def _pick_parallel_decompressor(afile: str):
+    """
+    return a command that decompresses `afile` to stdout using all
+    cores or None if no suitable decompressor is installed.
+    """
+    if afile.endswith(".gz") and binary_in_path("pigz"):
+        return get_cmd_or_die("pigz")["-dc"]
+    if afile.endswith(".xz"):
+        if binary_in_path("pixz"):
+            return get_cmd_or_die("pixz")["-d"]
+        if binary_in_path("xz"):
+            return get_cmd_or_die("xz")["-T0", "-dc"]
+    return None
+
+
+def _unpack_archive(afile: str, scratch: str) -> None:
+    """
+    unpack the tarball `afile` into the directory `scratch`.
+    """
     tar = get_cmd_or_die("tar")
+    decompressor = _pick_parallel_decompressor(afile)
+    if not decompressor:
+        # tar unpacks far faster than tarfile, which holds the GIL for
+        # every member. pass absolute paths since workers share the cwd.
+        invoke_quietly(tar, "-C", scratch, "-xf", afile)
+        return
+
+    # equivalent to `(decompressor < afile) | tar[...]` but started by
+    # hand so the decompressor's stderr can still be read once both exit.
+    logging.debug("decompressing %s with %s", afile, decompressor)
+    decomp = (decompressor < afile).popen()
+    untar = None
+    finished = False
+    try:
+        untar = tar["-C", scratch, "-xf", "-"].popen(stdin=decomp.stdout)
+        # let the decompressor get SIGPIPE if tar exits early
+        decomp.stdout.close()
+        _, tar_stderr = untar.communicate()
+        finished = True
+    finally:
+        if not finished:
+            # interrupted or tar failed to start; stop both processes
+            for proc in (untar, decomp):
+                if proc and proc.poll() is None:
+                    proc.kill()
+            if untar:
+                untar.wait()
+        _, stderr = decomp.communicate()
+
+    # a truncated or corrupt archive makes the decompressor fail first;
+    # it only gets SIGPIPE when tar gave up on its own.
+    if decomp.returncode and decomp.returncode != -signal.SIGPIPE:
+        logging.fatal(stderr.decode())
+        emsg = "could not decompress {}: {} exited with code {}"
+        die(emsg.format(afile, decompressor, decomp.returncode),
+            decomp.returncode)
+    if untar.returncode:
+        logging.fatal(tar_stderr.decode())
+        die("could not extract " + afile, untar.returncode)
+
+
+def _extract_archive(afile: str, adir: str) -> str:
+    """
+    extract `afile` into a fresh scratch directory under c.BUILD_DIR
+    and return the path of the top-level directory `adir` it contains.
+    """
+    scratch = tempfile.mkdtemp(prefix=EXTRACT_PREFIX, dir=c.BUILD_DIR)
+    logging.info("extracting %s", os.path.basename(afile))
+    try:
+        _unpack_archive(afile, scratch)
+    except BaseException:
+        # also covers die() and interrupts so no partial tree is left
+        shutil.rmtree(scratch, ignore_errors=True)
+        raise
+    return os.path.join(scratch, adir)
+
+
+def _fetch_archive(aurl: str, asig: str, afile: str, adir: str,
+                   dest: str) -> Optional[str]:
+    """
+    download and verify `afile`, then extract it unless `dest` exists.
+    returns the extracted directory or None if nothing was extracted.
+    """
+    download_archive(aurl, afile, asig)
+    if os.path.isdir(dest):
+        return None
+    return _extract_archive(afile, adir)
 
+
+def download_llvm_sources():
     # make sure we have the gpg public key installed first
     install_sig(c.LLVM_PUBKEY)
 
-    with pb.local.cwd(c.BUILD_DIR):
-        # download archives and signatures
-        for (aurl, asig, afile, _) in zip(
-                c.LLVM_ARCHIVE_URLS,
-                c.LLVM_SIGNATURE_URLS,
-                c.LLVM_ARCHIVE_FILES,
-                c.LLVM_ARCHIVE_DIRS):
-
-            # download archive + signature
-            download_archive(aurl, afile, asig)
-
-    # first extract llvm archive
-    if not os.path.isdir(c.LLVM_SRC):
-        logging.info("extracting %s", c.LLVM_ARCHIVE_FILES[0])
-        tar("xf", c.LLVM_ARCHIVE_FILES[0])
-        os.rename(c.LLVM_ARCHIVE_DIRS[0], c.LLVM_SRC)
-
-    # then clang front end
-    with pb.local.cwd(os.path.join(c.LLVM_SRC, "tools")):
-        if not os.path.isdir("clang"):
-            logging.info("extracting %s", c.LLVM_ARCHIVE_FILES[1])
-            tar("xf", os.path.join(c.ROOT_DIR, c.LLVM_ARCHIVE_FILES[1]))
-            os.rename(c.LLVM_ARCHIVE_DIRS[1], "clang")
-
-        with pb.local.cwd("clang/tools"):
-            if not os.path.isdir("extra"):
-                logging.info("extracting %s", c.LLVM_ARCHIVE_FILES[2])
-                tar("xf", os.path.join(c.ROOT_DIR, c.LLVM_ARCHIVE_FILES[2]))
-                os.rename(c.LLVM_ARCHIVE_DIRS[2], "extra")
+    # remove scratch dirs left behind if a previous run was killed
+    with os.scandir(c.BUILD_DIR) as entries:
+        for entry in entries:
+            if entry.name.startswith(EXTRACT_PREFIX) and \
+                    entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+    # llvm first, then the clang front end, then the extra clang tools.
+    # each archive is extracted as soon as its download completes so
+    # extraction overlaps with the remaining downloads. the archives nest
+    # inside each other so their trees are moved into place in order.
+    dests = [c.LLVM_SRC,
+             os.path.join(c.LLVM_SRC, "tools", "clang"),
+             os.path.join(c.LLVM_SRC, "tools", "clang", "tools", "extra")]
+    with pb.local.cwd(c.BUILD_DIR), \
+            ThreadPoolExecutor(max_workers=len(dests)) as ex:
+        fetches = [(ex.submit(_fetch_archive, aurl, asig, afile, adir, dest),
+                    dest)
+                   for (aurl, asig, afile, adir, dest) in zip(
+                       c.LLVM_ARCHIVE_URLS,
+                       c.LLVM_SIGNATURE_URLS,
+                       c.LLVM_ARCHIVE_FILES,
+                       c.LLVM_ARCHIVE_DIRS,
+                       dests)]
+        for (fetch, dest) in fetches:
+            src = fetch.result()
+            if src:
+                os.rename(src, dest)
+                shutil.rmtree(os.path.dirname(src), ignore_errors=True)
 
 
 def update_cmakelists():
@@ -81,17 +191,32 @@ def update_cmakelists():
         die("not found: " + filepath, errno.ENOENT)
 
     # did we add the required command already?
-    with open(filepath, "r") as handle:
-        cmakelists = handle.readlines()
-        add_commands = not any([command in l for l in cmakelists])
+    with open(filepath, "rb") as handle:
+        add_commands = command.encode() not in handle.read()
         logging.debug("add commands to %s: %s", filepath, add_commands)
 
     if add_commands:
-        with open(filepath, "a+") as handle:
-            handle.writelines(command)
+        # put the command on its own line even if the file lacks a
+        # trailing newline
+        with open(filepath, "ab") as handle:
+            handle.write(b"\n" + command.encode() + b"\n")
         logging.debug("added commands to %s", filepath)
 
 
+def _read_stamp(path: str) -> Optional[str]:
+    """
+    return the contents of the stamp file at `path` if it exists.
+    """
+    if not os.path.isfile(path):
+        return None
+    with open(path, "r") as handle:
+        return handle.read()
+
+
+def _hash_args(cargs: List[str]) -> str:
+    return hashlib.sha256("\n".join(cargs).encode()).hexdigest()
+
+
 def configure_and_build_llvm(args) -> None:
     """
     run cmake as needed to generate ninja buildfiles. then run ninja.
@@ -99,49 +224,74 @@ def configure_and_build_llvm(args) -> None:
     # Possible values are Release, Debug, RelWithDebInfo and MinSizeRel
     build_type = "Debug" if args.debug else "RelWithDebInfo"
     ninja_build_file = os.path.join(c.LLVM_BLD, "build.ninja")
+    cmake_stamp = os.path.join(c.LLVM_BLD, CMAKE_STAMP_NAME)
     with pb.local.cwd(c.LLVM_BLD):
-        if os.path.isfile(ninja_build_file) and not args.xcode:
-            prev_build_type = get_ninja_build_type(ninja_build_file)
-            run_cmake = prev_build_type != build_type
-        else:
+        clang = get_cmd_or_die("clang")
+        clangpp = get_cmd_or_die("clang++")
+        max_link_jobs = est_parallel_link_jobs()
+        assertions = "1" if args.assertions else "0"
+        ast_ext_dir = "-DLLVM_EXTERNAL_C2RUST_AST_EXPORTER_SOURCE_DIR={}"
+        ast_ext_dir = ast_ext_dir.format(c.AST_EXPO_SRC_DIR)
+        cargs = ["-G", "Ninja", c.LLVM_SRC,
+                 "-Wno-dev",
+                 "-DCMAKE_C_COMPILER={}".format(clang),
+                 "-DCMAKE_CXX_COMPILER={}".format(clangpp),
+                 "-DCMAKE_INSTALL_PREFIX=" + c.LLVM_INSTALL,
+                 "-DCMAKE_BUILD_TYPE=" + build_type,
+                 "-DLLVM_PARALLEL_LINK_JOBS={}".format(max_link_jobs),
+                 "-DLLVM_ENABLE_ASSERTIONS=" + assertions,
+                 "-DCMAKE_EXPORT_COMPILE_COMMANDS=1",
+                 # required to build LLVM 8 on Debian Jessie
+                 "-DLLVM_TEMPORARILY_ALLOW_OLD_TOOLCHAIN=1",
+                 ast_ext_dir]
+
+        if on_x86():  # speed up builds on x86 hosts
+            cargs.append("-DLLVM_TARGETS_TO_BUILD=X86")
+        if on_linux():
+            # link with a multi-threaded linker if one is available
+            # and don't relink executables when only a shared
+            # library they depend on changed.
+            if binary_in_path("ld.lld"):
+                cargs.append("-DLLVM_USE_LINKER=lld")
+            elif binary_in_path("ld.mold"):
+                cargs.append("-DLLVM_USE_LINKER=mold")
+            cargs.append("-DCMAKE_LINK_DEPENDS_NO_SHARED=ON")
+
+        # re-running cmake re-stamps generated headers and triggers large
+        # rebuilds so only do it when its inputs changed since last time.
+        cmake_hash = _hash_args(cargs)
+        if not os.path.isfile(ninja_build_file):
+            run_cmake = True
+        elif get_ninja_build_type(ninja_build_file) != build_type:
             run_cmake = True
+        else:
+            run_cmake = _read_stamp(cmake_stamp) != cmake_hash
 
+        cmake = get_cmd_or_die("cmake")
         if run_cmake:
-            cmake = get_cmd_or_die("cmake")
-            clang = get_cmd_or_die("clang")
-            clangpp = get_cmd_or_die("clang++")
-            max_link_jobs = est_parallel_link_jobs()
-            assertions = "1" if args.assertions else "0"
-            ast_ext_dir = "-DLLVM_EXTERNAL_C2RUST_AST_EXPORTER_SOURCE_DIR={}"
-            ast_ext_dir = ast_ext_dir.format(c.AST_EXPO_SRC_DIR)
-            cargs = ["-G", "Ninja", c.LLVM_SRC,
-                     "-Wno-dev",
-                     "-DCMAKE_C_COMPILER={}".format(clang),
-                     "-DCMAKE_CXX_COMPILER={}".format(clangpp),
-                     "-DCMAKE_INSTALL_PREFIX=" + c.LLVM_INSTALL,
-                     "-DCMAKE_BUILD_TYPE=" + build_type,
-                     "-DLLVM_PARALLEL_LINK_JOBS={}".format(max_link_jobs),
-                     "-DLLVM_ENABLE_ASSERTIONS=" + assertions,
-                     "-DCMAKE_EXPORT_COMPILE_COMMANDS=1",
-                     # required to build LLVM 8 on Debian Jessie
-                     "-DLLVM_TEMPORARILY_ALLOW_OLD_TOOLCHAIN=1",
-                     ast_ext_dir]
-
-            if on_x86():  # speed up builds on x86 hosts
-                cargs.append("-DLLVM_TARGETS_TO_BUILD=X86")
             invoke(cmake[cargs])
-
-            # NOTE: we only generate Xcode project files for IDE support
-            # and don't build with them since the cargo build.rs files
-            # rely on cmake to build native code.
-            if args.xcode:
-                cargs[1] = "Xcode"
+            with open(cmake_stamp, "w") as handle:
+                handle.write(cmake_hash)
+        else:
+            logging.debug("cmake inputs unchanged, not running cmake")
+
+        # NOTE: we only generate Xcode project files for IDE support
+        # and don't build with them since the cargo build.rs files
+        # rely on cmake to build native code.
+        if args.xcode:
+            xcode_cargs = ["-G", "Xcode"] + cargs[2:]
+            xcode_hash = _hash_args(xcode_cargs)
+            xcode_stamp = os.path.join(c.AST_EXPO_PRJ_DIR, CMAKE_STAMP_NAME)
+            if _read_stamp(xcode_stamp) != xcode_hash:
                 # output Xcode project files in a separate dir
                 ensure_dir(c.AST_EXPO_PRJ_DIR)
                 with pb.local.cwd(c.AST_EXPO_PRJ_DIR):
-                    invoke(cmake[cargs])
-        else:
-            logging.debug("found existing ninja.build, not running cmake")
+                    invoke(cmake[xcode_cargs])
+                with open(xcode_stamp, "w") as handle:
+                    handle.write(xcode_hash)
+            else:
+                logging.debug("cmake inputs unchanged, not running cmake "
+                              "for Xcode")
 
         # if args.xcode:
         #     xcodebuild = get_cmd_or_die("xcodebuild")
@@ -163,6 +313,11 @@ def configure_and_build_llvm(args) -> None:
                       'FileCheck', 'count', 'not']
         if args.with_clang:
             ninja_args.append('clang')
+        # keep compiles fully parallel but stop spawning jobs once the
+        # host is overloaded; links are throttled by the link_job_pool
+        # that LLVM_PARALLEL_LINK_JOBS sets up.
+        max_load = str(int(c.NCPUS) + 2)
+        ninja_args = ['-j', c.NCPUS, '-l', max_load] + ninja_args
         invoke(ninja, *ninja_args)
 
         # Make sure install/bin exists so that we can create a relative path
@@ -170,6 +325,44 @@ def configure_and_build_llvm(args) -> None:
         os.makedirs(os.path.join(c.LLVM_INSTALL, 'bin'), exist_ok=True)
 
 
+def _changed_since(root: str, ref_ns: int,
+                   prune: Optional[Callable[[str], bool]] = None):
+    """
+    lazily yield paths under (and including) `root` whose status changed
+    after `ref_ns`, like `find root -cnewer ref` without symlink following.
+    directories for which `prune` returns true are skipped entirely.
+    """
+    if os.lstat(root).st_ctime_ns > ref_ns:
+        yield root
+    pending = [root]
+    while pending:
+        with os.scandir(pending.pop()) as entries:
+            for entry in entries:
+                if prune and entry.is_dir(follow_symlinks=False) and \
+                        prune(entry.path):
+                    continue
+                if entry.stat(follow_symlinks=False).st_ctime_ns > ref_ns:
+                    yield entry.path
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+
+
+def _clean_stamp_valid(c2rust: str) -> bool:
+    """
+    return true if CLEAN_STAMP is newer than the c2rust binary and
+    neither c.BUILD_DIR nor the LLVM build log changed after it.
+    """
+    if not os.path.isfile(CLEAN_STAMP):
+        return False
+    stamp_mtime = os.path.getmtime(CLEAN_STAMP)
+    if os.path.getctime(c2rust) > stamp_mtime:
+        return False
+    ninja_log = os.path.join(c.LLVM_BLD, ".ninja_log")
+    sentinels = [c.BUILD_DIR, ninja_log]
+    return all(os.path.getmtime(s) <= stamp_mtime
+               for s in sentinels if os.path.exists(s))
+
+
 def need_cargo_clean(args) -> bool:
     """
     Cargo may not pick up changes in c.BUILD_DIR that would require
@@ -180,16 +373,25 @@ def need_cargo_clean(args) -> bool:
         logging.debug("need_cargo_clean:False:no-c2rust-bin")
         return False
 
-    find = get_cmd_or_die("find")
-    _retcode, stdout, _ = invoke_quietly(find, c.BUILD_DIR, "-cnewer", c2rust)
+    if _clean_stamp_valid(c2rust):
+        logging.debug("need_cargo_clean:False:clean-stamp")
+        return False
+
     include_pattern = "install/lib/clang/{ver}/include".format(ver=c.LLVM_VER)
-    for line in stdout.split("\n")[:-1]:  # skip empty last line
-        if line.endswith("install_manifest_clang-headers.txt") or \
-                line.endswith("ninja_log") or \
-                include_pattern in line:
+    ref_ns = os.stat(c2rust).st_mtime_ns
+
+    def in_clang_headers(path: str) -> bool:
+        # nothing below the installed clang headers can require a clean
+        return include_pattern in path
+
+    for path in _changed_since(c.BUILD_DIR, ref_ns, in_clang_headers):
+        if path.endswith("install_manifest_clang-headers.txt") or \
+                path.endswith("ninja_log") or \
+                path.endswith(BOOKKEEPING_SUFFIXES) or \
+                in_clang_headers(path):
             continue
         else:
-            logging.debug("need_cargo_clean:True:%s", line)
+            logging.debug("need_cargo_clean:True:%s", path)
             return True
     logging.debug("need_cargo_clean:False")
     return False
@@ -209,8 +411,8 @@ def build_transpiler(args):
     if args.verbose:
         build_flags.append("-vv")
 
+    # built by configure_and_build_llvm, which dies if ninja fails
     llvm_config = os.path.join(c.LLVM_BLD, "bin/llvm-config")
-    assert os.path.isfile(llvm_config), "missing binary: " + llvm_config
 
     if on_mac():
         llvm_system_libs = "-lz -lcurses -lm -lxml2"
@@ -220,15 +422,16 @@ def build_transpiler(args):
     llvm_libdir = os.path.join(c.LLVM_BLD, "lib")
 
     # log how we run `cargo build` to aid troubleshooting, IDE setup, etc.
-    msg = "invoking cargo build as\ncd {} && \\\n".format(c.C2RUST_DIR)
-    msg += "LIBCURL_NO_PKG_CONFIG=1\\\n"
-    msg += "ZLIB_NO_PKG_CONFIG=1\\\n"
-    msg += "LLVM_CONFIG_PATH={} \\\n".format(llvm_config)
-    msg += "LLVM_SYSTEM_LIBS='{}' \\\n".format(llvm_system_libs)
-    msg += "C2RUST_AST_EXPORTER_LIB_DIR={} \\\n".format(llvm_libdir)
-    msg += " cargo"
-    msg += " ".join(build_flags)
-    logging.debug(msg)
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        msg = " \\\n".join([
+            "invoking cargo build as\ncd {} &&".format(c.C2RUST_DIR),
+            "LIBCURL_NO_PKG_CONFIG=1",
+            "ZLIB_NO_PKG_CONFIG=1",
+            "LLVM_CONFIG_PATH={}".format(llvm_config),
+            "LLVM_SYSTEM_LIBS='{}'".format(llvm_system_libs),
+            "C2RUST_AST_EXPORTER_LIB_DIR={}".format(llvm_libdir),
+            " ".join(["cargo"] + build_flags)])
+        logging.debug(msg)
 
     # NOTE: the `curl-rust` and `libz-sys` crates use the `pkg_config`
     # crate to locate the system libraries they wrap. This causes
@@ -244,6 +447,9 @@ def build_transpiler(args):
                           C2RUST_AST_EXPORTER_LIB_DIR=llvm_libdir):
             invoke(cargo, *build_flags)
 
+    with open(CLEAN_STAMP, "w") as handle:
+        handle.write(str(time.time_ns()))
+
 
 def _parse_args():
     """
@@ -282,15 +488,6 @@ def _parse_args():
     return args
 
 
-def binary_in_path(binary_name) -> bool:
-    try:
-        # raises CommandNotFound exception if not available.
-        _ = pb.local[binary_name]  # noqa: F841
-        return True
-    except pb.CommandNotFound:
-        return False
-
-
 def c2rust_bin_path(args):
     c2rust_bin_path = 'target/debug/c2rust' if args.debug \
                       else 'target/release/c2rust'
@@ -330,10 +527,14 @@ def _main():
 
     if args.clean_all:
         logging.info("cleaning all dependencies and previous built files")
-        shutil.rmtree(c.LLVM_SRC, ignore_errors=True)
-        shutil.rmtree(c.LLVM_BLD, ignore_errors=True)
-        shutil.rmtree(c.BUILD_DIR, ignore_errors=True)
-        shutil.rmtree(c.AST_EXPO_PRJ_DIR, ignore_errors=True)
+        # removing these trees is bound by per-file unlink latency so
+        # delete them concurrently. the LLVM trees live inside BUILD_DIR,
+        # so only remove what is left of it once they are gone.
+        rmtree = functools.partial(shutil.rmtree, ignore_errors=True)
+        dirs = [c.LLVM_SRC, c.LLVM_BLD, c.AST_EXPO_PRJ_DIR]
+        with ThreadPoolExecutor(max_workers=len(dirs)) as ex:
+            list(ex.map(rmtree, dirs))
+        rmtree(c.BUILD_DIR)
         cargo = get_cmd_or_die("cargo")
         with pb.local.cwd(c.ROOT_DIR):
             invoke(cargo, "clean")
@@ -4,11 +4,13 @@ import re
 import sys
 import json
 import errno
+import mmap
 import psutil
 import signal
 import logging
 import argparse
 import platform
+import functools
 import multiprocessing
 
 from typing import Optional, List, Callable
@@ -259,6 +261,7 @@ def die(emsg, ecode=1):
     quit(ecode)
 
 
+@functools.lru_cache(maxsize=None)
 def est_parallel_link_jobs():
     """
     estimate the highest number of parallel link jobs we can
@@ -302,12 +305,27 @@ def _invoke(console_output, cmd, *arguments):
 Command = pb.machines.LocalCommand
 
 
+@functools.lru_cache(maxsize=None)
+def _lookup_path_cmd(cmd: str) -> Command:
+    """
+    search PATH for a command once per process.
+    """
+    return pb.local[cmd]
+
+
+def _lookup_cmd(cmd: str) -> Command:
+    # paths may be relative to pb.local.cwd so only cache PATH lookups
+    if os.sep in cmd:
+        return pb.local[cmd]
+    return _lookup_path_cmd(cmd)
+
+
 def get_cmd_or_die(cmd: str) -> Command:
     """
     lookup named command or terminate script.
     """
     try:
-        return pb.local[cmd]
+        return _lookup_cmd(cmd)
     except pb.CommandNotFound:
         die("{} not in path".format(cmd), errno.ENOENT)
 
@@ -351,7 +369,7 @@ def setup_logging(log_level=logging.INFO):
 def binary_in_path(binary_name) -> bool:
     try:
         # raises CommandNotFound exception if not available.
-        _ = pb.local[binary_name]
+        _ = _lookup_cmd(binary_name)
         return True
     except pb.CommandNotFound:
         return False
@@ -418,19 +436,27 @@ def ensure_clang_version(min_ver: List[int]):
         assert False, "run this script on macOS or linux"
 
 
+NINJA_SIGNATURE = ("# CMAKE generated file: DO NOT EDIT!" + os.linesep).encode()
+NINJA_BUILD_TYPE_RE = re.compile(rb'^#[ \t]*Configuration:[ \t]*(\w+)',
+                                 re.MULTILINE)
+
+
 def get_ninja_build_type(ninja_build_file):
-    signature = "# CMAKE generated file: DO NOT EDIT!" + os.linesep
-    with open(ninja_build_file, "r") as handle:
-        lines = handle.readlines()
-        if not lines[0] == signature:
+    """
+    return the build type cmake recorded in the header of a build.ninja
+    file. the file is mapped rather than read since it can be tens of MB
+    and the configuration appears near the top.
+    """
+    with open(ninja_build_file, "rb") as handle:
+        if os.fstat(handle.fileno()).st_size < len(NINJA_SIGNATURE):
             die("unexpected content in ninja.build: " + ninja_build_file)
-        r = re.compile(r'^#\s*Configuration:\s*(\w+)')
-        for line in lines:
-            m = r.match(line)
+        with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data[:len(NINJA_SIGNATURE)] != NINJA_SIGNATURE:
+                die("unexpected content in ninja.build: " + ninja_build_file)
+            m = NINJA_BUILD_TYPE_RE.search(data)
             if m:
-                # print m.group(1)
-                return m.group(1)
-        die("missing content in ninja.build: " + ninja_build_file)
+                return m.group(1).decode()
+            die("missing content in ninja.build: " + ninja_build_file)
 
 
 def export_ast_from(ast_expo: pb.commands.BaseCommand,
@@ -597,7 +623,44 @@ def check_sig(afile: str, asigfile: str) -> None:
         die("gpg signature check failed: " + pee.message)
 
 
+def _sig_stamp_path(afile: str) -> str:
+    return afile + ".verified"
+
+
+def _sig_fingerprint(afile: str) -> Optional[str]:
+    """
+    describe `afile` and its signature by size and mtime in nanoseconds
+    or return None if either file is missing.
+    """
+    lines = []
+    for f in [afile, afile + ".sig"]:
+        try:
+            st = os.stat(f)
+        except FileNotFoundError:
+            return None
+        lines.append("{} {} {}".format(os.path.basename(f),
+                                       st.st_size, st.st_mtime_ns))
+    return "\n".join(lines) + "\n"
+
+
+def archive_verified(afile: str) -> bool:
+    """
+    return true if `afile` and its signature passed `check_sig` and
+    neither file changed since.
+    """
+    stamp = _sig_stamp_path(afile)
+    fingerprint = _sig_fingerprint(afile)
+    if fingerprint is None or not os.path.isfile(stamp):
+        return False
+    with open(stamp, "r") as handle:
+        return handle.read() == fingerprint
+
+
 def download_archive(aurl: str, afile: str, asig: str = None):
+    if asig and archive_verified(afile):
+        logging.debug("found verified archive %s", os.path.basename(afile))
+        return
+
     curl = get_cmd_or_die("curl")
 
     def _download_helper(url: str, ofile: str):
@@ -626,6 +689,9 @@ def download_archive(aurl: str, afile: str, asig: str = None):
     _download_helper(asig, asigfile)
 
     check_sig(afile, asigfile)
+    # remember the outcome so later runs can skip the gpg round-trip
+    with open(_sig_stamp_path(afile), "w") as handle:
+        handle.write(_sig_fingerprint(afile))
 
 
 class NonZeroReturn(Exception):